@@ -1,4 +1,6 @@
-from math import pi, sin, cos
+from math import pi, sin, cos, floor, inf
+
+import numpy as np
 
 from direct.showbase.ShowBase import ShowBase
 from panda3d.core import loadPrcFile
@@ -6,15 +8,76 @@ from panda3d.core import DirectionalLight, AmbientLight
 from panda3d.core import TransparencyAttrib
 from panda3d.core import WindowProperties
 from panda3d.core import CollisionTraverser, CollisionNode, CollisionBox, CollisionRay, CollisionHandlerQueue
+from panda3d.core import RigidBodyCombiner, BitMask32, OmniBoundingVolume
 from direct.gui.OnscreenImage import OnscreenImage
 from direct.gui.DirectGui import DirectFrame, DirectButton, DirectLabel
-from panda3d.core import TextNode, Vec4
+from panda3d.core import TextNode, Vec3, Vec4
 
 loadPrcFile('settings.prc')
 
+CHUNK_SIZE = 16  # Blocks per chunk along each axis
+BLOCK_TYPES = ('grass', 'dirt', 'sand', 'stone')  # Stored in terrain arrays as index + 1, with 0 meaning empty
+TERRAIN_FILE = 'terrain.npy'
+TERRAIN_SHAPE = (10, 20, 20)  # [z, y, x]
+
 def degToRad(degrees):
     return degrees * (pi / 180.0)
 
+def blockKey(x, y, z):
+    # Blocks are 2 units wide, so world positions map onto an integer grid
+    return (round(x / 2), round(y / 2), round(z / 2))
+
+def raycastBlocks(blocks, origin, direction, maxDistance):
+    # Amanatides & Woo grid traversal: visit the cells along the ray in order
+    # and return the key of the first block hit plus the normal of the face the
+    # ray entered through. Block k spans world coordinates 2k - 1 to 2k + 1.
+    cell = [floor((origin[i] + 1) / 2) for i in range(3)]
+    step = [0, 0, 0]
+    tMax = [inf, inf, inf]
+    tDelta = [inf, inf, inf]
+
+    for i in range(3):
+        if direction[i] > 0:
+            step[i] = 1
+            tMax[i] = (cell[i] * 2 + 1 - origin[i]) / direction[i]
+            tDelta[i] = 2 / direction[i]
+        elif direction[i] < 0:
+            step[i] = -1
+            tMax[i] = (cell[i] * 2 - 1 - origin[i]) / direction[i]
+            tDelta[i] = -2 / direction[i]
+
+    normal = None
+    distance = 0
+    while distance <= maxDistance:
+        key = (cell[0], cell[1], cell[2])
+        if key in blocks:
+            return key, normal
+
+        if tMax[0] < tMax[1] and tMax[0] < tMax[2]:
+            axis = 0
+        elif tMax[1] < tMax[2]:
+            axis = 1
+        else:
+            axis = 2
+
+        distance = tMax[axis]
+        tMax[axis] += tDelta[axis]
+        cell[axis] += step[axis]
+        normal = [0, 0, 0]
+        normal[axis] = -step[axis]
+
+    return None, None
+
+def stepCameraLook(h, p, mouseChangeX, mouseChangeY, dt, swingFactor):
+    newH = h - mouseChangeX * dt * swingFactor
+    newP = p - mouseChangeY * dt * swingFactor
+    if newP > 90:
+        newP = 90.0
+    elif newP < -90:
+        newP = -90.0
+
+    return newH, newP
+
 class MyGame(ShowBase):
     def __init__(self):
         ShowBase.__init__(self)
@@ -4073,11 +4136,17 @@ class MyGame(ShowBase):
     def __init__(self):
         ShowBase.__init__(self)
 
+        # Bound methods called every frame from update
+        self.getDt = self.clock.getDt
+        self.getPointer = self.win.getPointer
+
         self.selectedBlockType = 'grass'
+        self.cameraSwingFactor = 10
+        self.captureMouseMode = WindowProperties.M_relative
 
+        self.setupBlocks()
         self.loadModels()
         self.setupLights()
-        self.generateTerrain()
         self.setupCamera()
         self.setupSkybox()
         self.captureMouse()
@@ -4089,67 +4158,72 @@ class MyGame(ShowBase):
         self.taskMgr.add(self.update, 'update')
 
     def loadModels(self):
-        self.blockModels = {
-            'grass': self.loader.loadModel('grass-block.glb'),
-            'dirt': self.loader.loadModel('dirt-block.glb'),
-            'sand': self.loader.loadModel('sand-block.glb'),
-            'stone': self.loader.loadModel('stone-block.glb')
-        }
+        # Load all block models in one background batch; the terrain is
+        # generated once they're ready
+        self.blockModelFiles = [type + '-block.glb' for type in BLOCK_TYPES]
+        self.loader.loadModel(self.blockModelFiles, callback=self.onModelsLoaded)
+
+    def onModelsLoaded(self, models):
+        # Async loads hand back None instead of raising, so fail here like a blocking load would
+        missing = [modelFile for modelFile, model in zip(self.blockModelFiles, models) if model is None]
+        if missing:
+            raise IOError('Could not load model file(s): %s' % missing)
+
+        self.blockModels = dict(zip(BLOCK_TYPES, models))
+        self.generateTerrain()
+
+    def setupBlocks(self):
+        self.chunks = {}
+
+        # Spatial hash of every block, keyed by its grid position
+        self.blocks = {}
 
     def update(self, task):
         if self.menuActive:
             return task.cont
 
-        dt = self.globalClock.getDt()
-
-        playerMoveSpeed = 10
-
-        x_movement = 0
-        y_movement = 0
-        z_movement = 0
-
-        if self.keyMap['forward']:
-            x_movement -= dt * playerMoveSpeed * sin(degToRad(self.camera.getH()))
-            y_movement += dt * playerMoveSpeed * cos(degToRad(self.camera.getH()))
-        if self.keyMap['backward']:
-            x_movement += dt * playerMoveSpeed * sin(degToRad(self.camera.getH()))
-            y_movement -= dt * playerMoveSpeed * cos(degToRad(self.camera.getH()))
-        if self.keyMap['left']:
-            x_movement -= dt * playerMoveSpeed * cos(degToRad(self.camera.getH()))
-            y_movement -= dt * playerMoveSpeed * sin(degToRad(self.camera.getH()))
-        if self.keyMap['right']:
-            x_movement += dt * playerMoveSpeed * cos(degToRad(self.camera.getH()))
-            y_movement += dt * playerMoveSpeed * sin(degToRad(self.camera.getH()))
-        if self.keyMap['up']:
-            z_movement += dt * playerMoveSpeed
-        if self.keyMap['down']:
-            z_movement -= dt * playerMoveSpeed
+        camera = self.camera
+        cameraSwingActivated = self.cameraSwingActivated
 
-        self.camera.setPos(
-            self.camera.getX() + x_movement,
-            self.camera.getY() + y_movement,
-            self.camera.getZ() + z_movement,
-        )
+        # Each axis is +1, -1 or 0 depending on which of its two keys are held
+        forward = self.keyForward - self.keyBackward
+        strafe = self.keyRight - self.keyLeft
+        vertical = self.keyUp - self.keyDown
 
-        if self.cameraSwingActivated:
-            md = self.win.getPointer(0)
+        if cameraSwingActivated:
+            md = self.getPointer(0)
             mouseX = md.getX()
             mouseY = md.getY()
 
             mouseChangeX = mouseX - self.lastMouseX
             mouseChangeY = mouseY - self.lastMouseY
+        else:
+            mouseChangeX = 0.0
+            mouseChangeY = 0.0
 
-            self.cameraSwingFactor = 10
+        # Nothing to do while the player is standing still and not looking around
+        if not (forward or strafe or vertical) and mouseChangeX == 0 and mouseChangeY == 0:
+            return task.cont
 
-            currentH = self.camera.getH()
-            currentP = self.camera.getP()
+        dt = self.getDt()
 
-            self.camera.setHpr(
-                currentH - mouseChangeX * dt * self.cameraSwingFactor,
-                min(90, max(-90, currentP - mouseChangeY * dt * self.cameraSwingFactor)),
-                0
-            )
+        playerMoveSpeed = 10
+
+        # The camera never rolls, so its right vector is always horizontal and
+        # turning it 90 degrees about Z gives the flat forward direction
+        right = camera.getQuat().getRight()
+        movement = Vec3(-right.y, right.x, 0) * forward + right * strafe
+        movement.z = vertical
+        pos = camera.getPos() + movement * (dt * playerMoveSpeed)
+
+        h, p = stepCameraLook(
+            camera.getH(), camera.getP(), mouseChangeX, mouseChangeY, dt, self.cameraSwingFactor
+        )
 
+        # One transform update instead of separate setPos and setHpr calls
+        camera.setPosHpr(pos, (h, p, 0))
+
+        if cameraSwingActivated:
             self.lastMouseX = mouseX
             self.lastMouseY = mouseY
 
@@ -4344,31 +4418,29 @@ class MyGame(ShowBase):
         return task.cont
     
     def setupControls(self):
-        self.keyMap = {
-            "forward": False,
-            "backward": False,
-            "left": False,
-            "right": False,
-            "up": False,
-            "down": False,
-        }
+        self.keyForward = 0
+        self.keyBackward = 0
+        self.keyLeft = 0
+        self.keyRight = 0
+        self.keyUp = 0
+        self.keyDown = 0
 
         self.accept('escape', self.toggleMenu)
         self.accept('mouse1', self.placeBlock)  # Left click to place blocks
         self.accept('mouse3', self.handleLeftClick)  # Right click to destroy blocks
 
-        self.accept('w', self.updateKeyMap, ['forward', True])
-        self.accept('w-up', self.updateKeyMap, ['forward', False])
-        self.accept('a', self.updateKeyMap, ['left', True])
-        self.accept('a-up', self.updateKeyMap, ['left', False])
-        self.accept('s', self.updateKeyMap, ['backward', True])
-        self.accept('s-up', self.updateKeyMap, ['backward', False])
-        self.accept('d', self.updateKeyMap, ['right', True])
-        self.accept('d-up', self.updateKeyMap, ['right', False])
-        self.accept('space', self.updateKeyMap, ['up', True])
-        self.accept('space-up', self.updateKeyMap, ['up', False])
-        self.accept('lshift', self.updateKeyMap, ['down', True])
-        self.accept('lshift-up', self.updateKeyMap, ['down', False])
+        self.accept('w', self.updateKeyMap, ['keyForward', 1])
+        self.accept('w-up', self.updateKeyMap, ['keyForward', 0])
+        self.accept('a', self.updateKeyMap, ['keyLeft', 1])
+        self.accept('a-up', self.updateKeyMap, ['keyLeft', 0])
+        self.accept('s', self.updateKeyMap, ['keyBackward', 1])
+        self.accept('s-up', self.updateKeyMap, ['keyBackward', 0])
+        self.accept('d', self.updateKeyMap, ['keyRight', 1])
+        self.accept('d-up', self.updateKeyMap, ['keyRight', 0])
+        self.accept('space', self.updateKeyMap, ['keyUp', 1])
+        self.accept('space-up', self.updateKeyMap, ['keyUp', 0])
+        self.accept('lshift', self.updateKeyMap, ['keyDown', 1])
+        self.accept('lshift-up', self.updateKeyMap, ['keyDown', 0])
     
     def setSelectedBlockType(self, type):
         self.selectedBlockType = type
@@ -4377,35 +4449,36 @@ class MyGame(ShowBase):
         self.captureMouse()
         self.removeBlock()
 
-    def removeBlock(self):
-        if self.rayQueue.getNumEntries() > 0:
-            self.rayQueue.sortEntries()
-            rayHit = self.rayQueue.getEntry(0)
+    def castRay(self):
+        # Walk the block grid along the line of sight instead of testing colliders
+        return raycastBlocks(self.blocks, self.camera.getPos(), self.camera.getQuat().getForward(), 14)
 
-            hitNodePath = rayHit.getIntoNodePath()
-            hitObject = hitNodePath.getPythonTag('owner')
+    def removeBlock(self):
+        key, normal = self.castRay()
+        if key is not None:
+            hitObject = self.blocks[key]
             distanceFromPlayer = hitObject.getDistance(self.camera)
 
             if distanceFromPlayer < 12:
-                hitNodePath.clearPythonTag('owner')
+                del self.blocks[key]
+                chunk = hitObject.getParent()
                 hitObject.removeNode()
+                chunk.node().collect()
 
     def placeBlock(self):
-        if self.rayQueue.getNumEntries() > 0:
-            self.rayQueue.sortEntries()
-            rayHit = self.rayQueue.getEntry(0)
-            hitNodePath = rayHit.getIntoNodePath()
-            normal = rayHit.getSurfaceNormal(hitNodePath)
-            hitObject = hitNodePath.getPythonTag('owner')
+        key, normal = self.castRay()
+        # No normal means the camera is inside the block, so there's no face to build on
+        if key is not None and normal is not None:
+            hitObject = self.blocks[key]
             distanceFromPlayer = hitObject.getDistance(self.camera)
 
             if distanceFromPlayer < 14:
-                hitBlockPos = hitObject.getPos()
-                newBlockPos = hitBlockPos + normal * 2
-                self.createNewBlock(newBlockPos.x, newBlockPos.y, newBlockPos.z, self.selectedBlockType)
+                newBlockPos = Vec3(key[0] + normal[0], key[1] + normal[1], key[2] + normal[2]) * 2
+                newBlock = self.createNewBlock(newBlockPos.x, newBlockPos.y, newBlockPos.z, self.selectedBlockType)
+                newBlock.getParent().node().collect()
 
     def updateKeyMap(self, key, value):
-        self.keyMap[key] = value
+        setattr(self, key, value)
 
     def captureMouse(self):
         self.cameraSwingActivated = True
@@ -4416,9 +4489,28 @@ class MyGame(ShowBase):
 
         properties = WindowProperties()
         properties.setCursorHidden(True)
-        properties.setMouseMode(WindowProperties.M_confined)  # Confine mouse to window
+        properties.setMouseMode(self.captureMouseMode)
         self.win.requestProperties(properties)
 
+        # Relative mode isn't available everywhere (on X11 it needs the DGA extension),
+        # so check what the window actually applied; runs after igLoop has processed the request
+        if self.captureMouseMode == WindowProperties.M_relative:
+            self.taskMgr.remove('checkMouseMode')
+            self.taskMgr.add(self.checkMouseMode, 'checkMouseMode', sort=60)
+
+    def checkMouseMode(self, task):
+        if not self.cameraSwingActivated:
+            return task.done
+
+        if self.win.getRequestedProperties().hasMouseMode():
+            return task.cont
+
+        if self.win.getProperties().getMouseMode() != WindowProperties.M_relative:
+            self.captureMouseMode = WindowProperties.M_confined  # Confine mouse to window instead
+            self.captureMouse()
+
+        return task.done
+
     def releaseMouse(self):
         self.cameraSwingActivated = False
 
@@ -4439,75 +4531,112 @@ class MyGame(ShowBase):
         )
         crosshairs.setTransparency(TransparencyAttrib.MAlpha)
 
-        self.cTrav = CollisionTraverser()
-        ray = CollisionRay()
-        ray.setFromLens(self.camNode, (0, 0))
-        rayNode = CollisionNode('line-of-sight')
-        rayNode.addSolid(ray)
-        rayNodePath = self.camera.attachNewNode(rayNode)
-        self.rayQueue = CollisionHandlerQueue()
-        self.cTrav.addCollider(rayNodePath, self.rayQueue)
-
     def setupSkybox(self):
         skybox = self.loader.loadModel('skybox/skybox.egg')
         skybox.setScale(500)
         skybox.setBin('background', 1)
         skybox.setDepthWrite(0)
+        skybox.setDepthTest(False)  # Drawn first in the background bin, so nothing to test against
         skybox.setLightOff()
+        skybox.setCollideMask(BitMask32.allOff())
+
+        # The skybox always surrounds the camera, so skip culling it altogether
+        skybox.node().setBounds(OmniBoundingVolume())
+        skybox.node().setFinal(True)
         skybox.reparentTo(self.render)
 
+    def loadTerrain(self):
+        # The starting terrain is the same on every launch, so build it once
+        # and memory-map the saved copy afterwards
+        try:
+            terrain = np.load(TERRAIN_FILE, mmap_mode='r')
+            if terrain.shape == TERRAIN_SHAPE and terrain.dtype == np.uint8:
+                return terrain
+        except (OSError, ValueError, EOFError):
+            pass  # Missing or unreadable, so rebuild it below
+
+        terrain = np.full(TERRAIN_SHAPE, BLOCK_TYPES.index('dirt') + 1, dtype=np.uint8)
+        terrain[0] = BLOCK_TYPES.index('grass') + 1
+
+        try:
+            np.save(TERRAIN_FILE, terrain)
+        except OSError:
+            pass  # The cache is only a shortcut; the game runs fine without it
+
+        return terrain
+
     def generateTerrain(self):
-        for z in range(10):
-            for y in range(20):
-                for x in range(20):
-                    self.createNewBlock(
-                        x * 2 - 20,
-                        y * 2 - 20,
-                        -z * 2,
-                        'grass' if z == 0 else 'dirt'
-                    )
+        terrain = self.loadTerrain()
 
-    def createNewBlock(self, x, y, z, type):
-        newBlockNode = self.render.attachNewNode('new-block-placeholder')
-        newBlockNode.setPos(x, y, z)
+        # One pass per block type, so the model and rotation are looked up once per pass
+        for typeIndex, type in enumerate(BLOCK_TYPES):
+            blockModel, blockHpr = self.getBlockAppearance(type)
+
+            zs, ys, xs = np.nonzero(terrain == typeIndex + 1)
+            blockXs = (xs * 2 - 20).tolist()
+            blockYs = (ys * 2 - 20).tolist()
+            blockZs = (-zs * 2).tolist()
+
+            for x, y, z in zip(blockXs, blockYs, blockZs):
+                self.addBlock(x, y, z, blockModel, blockHpr)
+
+        for chunk in self.chunks.values():
+            chunk.node().collect()
+
+    def getChunk(self, x, y, z):
+        blockX, blockY, blockZ = blockKey(x, y, z)
+        chunkKey = (blockX // CHUNK_SIZE, blockY // CHUNK_SIZE, blockZ // CHUNK_SIZE)
+        chunk = self.chunks.get(chunkKey)
+        if chunk is None:
+            chunk = self.render.attachNewNode(RigidBodyCombiner('chunk'))
+            self.chunks[chunkKey] = chunk
+        return chunk
 
+    def getBlockAppearance(self, type):
         # Fix grass texture orientation by rotating the grass block model
         if type == 'grass':
-            self.grassBlock.instanceTo(newBlockNode)
-            newBlockNode.setHpr(0, 90, 0)  # Rotate 90 degrees on pitch to fix texture orientation
-        elif type == 'dirt':
-            self.dirtBlock.instanceTo(newBlockNode)
-        elif type == 'sand':
-            self.sandBlock.instanceTo(newBlockNode)
-        elif type == 'stone':
-            self.stoneBlock.instanceTo(newBlockNode)
+            return self.blockModels[type], (0, 90, 0)  # Rotate 90 degrees on pitch to fix texture orientation
+        return self.blockModels[type], (0, 0, 0)
 
-        blockSolid = CollisionBox((-1, -1, -1), (1, 1, 1))
-        blockNode = CollisionNode('block-collision-node')
-        blockNode.addSolid(blockSolid)
-        collider = newBlockNode.attachNewNode(blockNode)
-        collider.setPythonTag('owner', newBlockNode)
+    def createNewBlock(self, x, y, z, type):
+        blockModel, blockHpr = self.getBlockAppearance(type)
+        return self.addBlock(x, y, z, blockModel, blockHpr)
+
+    def addBlock(self, x, y, z, blockModel, blockHpr):
+        newBlockNode = self.getChunk(x, y, z).attachNewNode('new-block-placeholder')
+        newBlockNode.setPosHpr((x, y, z), blockHpr)
+        blockModel.instanceTo(newBlockNode)
+
+        self.blocks[blockKey(x, y, z)] = newBlockNode
+
+        return newBlockNode
 
     def createMenu(self):
         self.menuFrame = DirectFrame(frameColor=(0, 0, 0, 0.5), frameSize=(-1, 1, -1, 1))
         self.menuFrame.hide()
 
+        # The button labels never change, so let DirectGui bake them into static geometry
         self.continueButton = DirectButton(
             text="Continue",
             scale=0.1,
             pos=(0, 0, 0.2),
-            command=self.toggleMenu
+            command=self.toggleMenu,
+            textMayChange=0
         )
         self.exitButton = DirectButton(
             text="Exit",
             scale=0.1,
             pos=(0, 0, -0.2),
-            command=self.exitGame
+            command=self.exitGame,
+            textMayChange=0
         )
 
         self.continueButton.reparentTo(self.menuFrame)
         self.exitButton.reparentTo(self.menuFrame)
 
+        self.menuFrame.setTransparency(TransparencyAttrib.MAlpha)
+        self.menuFrame.flattenStrong()
+
     def toggleMenu(self):
         if self.menuActive:
             self.menuFrame.hide()